@@ -5,20 +5,43 @@ import os
 import re
 import pwd
 import csv
+import copy
 import time
+import heapq
 import shutil
-import pathlib
+import operator
 import datetime
+import functools
 import subprocess
 import itertools as it
-from collections import OrderedDict, abc
+from collections import abc
+from concurrent.futures import ThreadPoolExecutor
 
 import elo
 import yaml
+import numpy as np
 import psutil
-from bs4 import BeautifulSoup
+from lxml import etree
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 DROPBOX_DEBUG = logging.DEBUG - 1
+RATINGS_BUFFER_SIZE = 1 << 16
+DRIVER_TO_PORT = {
+    'scr_server 1': 3001,
+    'scr_server 2': 3002,
+    'scr_server 3': 3003,
+    'scr_server 4': 3004,
+    'scr_server 5': 3005,
+    'scr_server 6': 3006,
+    'scr_server 7': 3007,
+    'scr_server 8': 3008,
+    'scr_server 9': 3009,
+    'scr_server 10': 3010,
+}
 EMPTY_START_SH = """
 #! /bin/bash
 echo "Exit with non-zero exit status because you don't have a working driver."
@@ -26,6 +49,18 @@ echo "Yet... :)"
 exit 1
 """
 
+# Query used to read a driver name from a TORCS results file
+NAME_XPATH = etree.XPath('attstr[@name="name"]/@val')
+# Queries used to read the line-up from a TORCS config file
+DRIVERS_XPATH = etree.XPath('(//section[@name="Drivers"])[1]/section')
+MODULE_XPATH = etree.XPath('attstr[@name="module"][1]')
+IDX_XPATH = etree.XPath('attnum[@name="idx"][1]')
+
+# Used to find out which configuration key a class didn't expect
+UNEXPECTED_KEYWORD_REGEX = re.compile(
+    r"__init__\(\) got an unexpected keyword argument '(\w+)'"
+)
+
 logger = logging.getLogger(None if __name__ == '__main__' else __name__)
 
 
@@ -35,15 +70,116 @@ def path_rel_to_dir(path, direcotry):
     return path
 
 
+@functools.lru_cache(maxsize=None)
+def get_password_record(user):
+    """
+    Return the password database entry of the given user.
+
+    Every user is only looked up once, because the lookup may have to go
+    through NSS, e.g. to an LDAP server.
+    """
+    return pwd.getpwnam(user)
+
+
+def poll_until(predicate, timeout, interval=0.01, max_interval=0.1,
+               factor=1.5):
+    """
+    Call `predicate` until it returns something truthy or `timeout` seconds
+    have passed, and return its last result.
+
+    The time between two calls starts at `interval` seconds and grows by
+    `factor` up to at most `max_interval` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = predicate()
+        remaining = deadline - time.monotonic()
+        if result or remaining <= 0:
+            return result
+        time.sleep(min(interval, remaining))
+        interval = min(interval * factor, max_interval)
+
+
 def really_running(proc):
     """Check whether a process is running _and_ isn't a zombie"""
     return proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE
 
 
-class OrderedLoader(yaml.Loader):
+def stop_waiting(processes, timeout):
+    """
+    Wait at most `timeout` seconds for the given processes to stop and return
+    a list of the processes that are still running.
+
+    Returns as soon as all processes have stopped.
+    """
+    running = list(processes)
+
+    def still_running(proc):
+        try:
+            return really_running(proc)
+        except psutil.NoSuchProcess:
+            # Reaped between the checks in `really_running`
+            return False
+
+    def all_stopped():
+        running[:] = [proc for proc in running if still_running(proc)]
+        return not running
+
+    poll_until(all_stopped, timeout)
+    return running
+
+
+def rate_ranking(ratings):
+    """
+    Return the new Elo ratings after a race, given an array of the old ratings
+    in the order the players finished.
+
+    Every player won from all players after it. The K-factor and rating
+    disparity are taken from the `elo` module.
+    """
+    n = len(ratings)
+    # expected[i, j] is the expected score of player i against player j
+    expected = 1. / (
+        1 + 10 ** ((ratings[None, :] - ratings[:, None]) / (2 * elo.BETA))
+    )
+    np.fill_diagonal(expected, 0)
+    # scores[i, j] is one if player i finished before player j
+    scores = np.triu(np.ones((n, n)), k=1)
+    return ratings + elo.K_FACTOR * (scores - expected).sum(axis=1)
+
+
+def bradley_terry(wins, prior=0.1, tolerance=1e-9, max_iterations=10000):
+    """
+    Return the ratings that maximise the Bradley-Terry likelihood of the given
+    pairwise results, on the same scale as Elo ratings and centred around
+    zero. `wins[i, j]` is the number of times player i won from player j.
+
+    `prior` is added to every pairwise win count, which keeps the ratings of
+    players that never won (or never lost) finite. The model is fitted using
+    the MM algorithm of Hunter (2004).
+    """
+    wins = np.asarray(wins, dtype=np.float64) + prior
+    np.fill_diagonal(wins, 0)
+    games = wins + wins.T
+    total_wins = wins.sum(axis=1)
+    strength = np.ones(len(wins))
+    for _ in range(max_iterations):
+        new_strength = total_wins / (
+            games / (strength[:, None] + strength[None, :])
+        ).sum(axis=1)
+        # Fix the geometric mean at one, since only ratios matter
+        new_strength /= np.exp(np.log(new_strength).mean())
+        converged = np.abs(new_strength - strength).max() < tolerance
+        strength = new_strength
+        if converged:
+            break
+    return 2 * elo.BETA * np.log10(strength)
+
+
+class OrderedLoader(SafeLoader):
     def construct_mapping(self, node, deep=False):
         # self.flatten_mapping(node)
-        return OrderedDict(self.construct_pairs(node, deep))
+        return dict(self.construct_pairs(node, deep))
 
 
 OrderedLoader.add_constructor(
@@ -52,6 +188,24 @@ OrderedLoader.add_constructor(
 )
 
 
+def load_yaml(filename):
+    """
+    Load a YAML file using the `OrderedLoader`.
+
+    The file is only parsed again when it has been modified. A copy of the
+    parsed content is returned, so the caller is free to change it.
+    """
+    return copy.deepcopy(parse_yaml(filename, os.path.getmtime(filename)))
+
+
+@functools.lru_cache(maxsize=16)
+def parse_yaml(filename, mtime):
+    # `mtime` is only used as part of the cache key
+    # libyaml decodes the file itself, so don't let Python decode it first
+    with open(filename, 'rb') as fd:
+        return yaml.load(fd, OrderedLoader)
+
+
 class ParseError(Exception):
     pass
 
@@ -99,6 +253,13 @@ class Player(object):
         else:
             self.init_rating()
         self.start_command = start_command
+        # Only arguments containing braces need to be formatted
+        self.start_command_template = [
+            (arg, '{' in arg or '}' in arg)
+            for arg in start_command
+        ]
+        # Formatted start commands by port
+        self.start_commands = {}
         self.output_dir = path_rel_to_dir(output_dir, self.working_dir)
         self.stdout = path_rel_to_dir(stdout, self.output_dir)
         self.stderr = path_rel_to_dir(stderr, self.output_dir)
@@ -109,8 +270,12 @@ class Player(object):
             if process_owner is not None \
             else self.token
 
-        if not os.path.exists(self.output_dir):
+        # Don't create missing parents, so a wrong `working_dir` isn't
+        # silently created either
+        try:
             os.mkdir(self.output_dir)
+        except FileExistsError:
+            pass
 
     def __str__(self):
         return self.__class__.__name__ + "({self.token!r}, " \
@@ -134,6 +299,15 @@ class Player(object):
     def init_rating(self):
         self.rating = elo.RATING_CLASS(elo.INITIAL)
 
+    def format_start_command(self, port):
+        """Return `start_command` with `port` filled in."""
+        if port not in self.start_commands:
+            self.start_commands[port] = tuple(
+                arg.format(port=port) if needs_format else arg
+                for arg, needs_format in self.start_command_template
+            )
+        return list(self.start_commands[port])
+
 
 class Rater(object):
     def __init__(self, players=(), filename=None,
@@ -169,7 +343,11 @@ class Rater(object):
 
     def read_file(self, filename=None):
         filename = self.filename_check(filename)
-        with open(filename) as fd:
+        with open(
+            filename,
+            buffering=RATINGS_BUFFER_SIZE,
+            newline=''
+        ) as fd:
             self.set_ratings(map(self.clean_line, csv.reader(fd)))
 
     def set_ratings(self, iterable):
@@ -225,41 +403,96 @@ class Rater(object):
         If a filename is specified, that file is used, otherwise
         `self.filename` is used. If neither is specified, a ValueError is
         raised.
+
+        The ratings are written to a temporary file first, which then
+        replaces the original. Like this a crash while saving never leaves a
+        partially written ratings file behind.
         """
         filename = self.filename_check(filename)
         logger.info("Saving ratings in {}".format(filename))
-        with open(filename, 'w') as fd:
-            csv.writer(fd).writerows(
-                sorted(
-                    ((p.token, p.rating) for p in self.player_map.values()),
-                    key=lambda p: p[1]
-                )
-            )
+        tmp_filename = filename + '.tmp'
+        with open(
+            tmp_filename,
+            'w',
+            buffering=RATINGS_BUFFER_SIZE,
+            newline=''
+        ) as fd:
+            rows = [(p.token, p.rating) for p in self.player_map.values()]
+            rows.sort(key=operator.itemgetter(1))
+            csv.writer(fd).writerows(rows)
+            # Make sure the data is on disk before it replaces the original
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_filename, filename)
 
     @staticmethod
     def adjust_all(ranking):
         """
         Adjust the ratings of given Players according to the ranked results.
 
-        In a ranking every player won from all players before it.
+        In a ranking every player won from all players after it.
         """
         ranking = list(ranking)
-        # Calculate new ratings
-        new_ratings = [
-            elo.rate(
-                player.rating,
-                [
-                    ((pi < oi), opponent.rating)
-                    for oi, opponent in enumerate(ranking)
-                    if opponent is not player
-                ]
-            )
-            for pi, player in enumerate(ranking)
-        ]
+        ratings = np.fromiter(
+            (float(player.rating) for player in ranking),
+            dtype=np.float64,
+            count=len(ranking)
+        )
+        new_ratings = rate_ranking(ratings)
 
         # Save new ratings
         for player, rating in zip(ranking, new_ratings):
-            player.rating = rating
+            player.rating = elo.RATING_CLASS(rating)
+
+    def adjust_batch(self, rankings):
+        """
+        Adjust the ratings of the players of this rater according to several
+        ranked results, in the given order.
+
+        This gives the same ratings as calling `adjust_all` for every ranking,
+        but the ratings are only written back to the Players once.
+        """
+        players = list(self.player_map.values())
+        index = {player.token: i for i, player in enumerate(players)}
+        ratings = np.fromiter(
+            (float(player.rating) for player in players),
+            dtype=np.float64,
+            count=len(players)
+        )
+        for ranking in rankings:
+            indices = [index[player.token] for player in ranking]
+            ratings[indices] = rate_ranking(ratings[indices])
+
+        for player, rating in zip(players, ratings):
+            player.rating = elo.RATING_CLASS(rating)
+
+    @staticmethod
+    def fit_ratings(rankings, prior=0.1):
+        """
+        Set the ratings of all Players in the given rankings by fitting a
+        Bradley-Terry model to all results at once (see `bradley_terry`).
+
+        Unlike with `adjust_all`, the ratings don't depend on the order of the
+        races. The fitted ratings are centred around `elo.INITIAL`.
+        """
+        rankings = [list(ranking) for ranking in rankings]
+        players = list(dict(
+            (player.token, player)
+            for ranking in rankings
+            for player in ranking
+        ).values())
+        index = {player.token: i for i, player in enumerate(players)}
+
+        # wins[i, j] is the number of times player i won from player j
+        wins = np.zeros((len(players), len(players)))
+        for ranking in rankings:
+            indices = [index[player.token] for player in ranking]
+            for position, i in enumerate(indices):
+                wins[i, indices[position + 1:]] += 1
+
+        ratings = elo.INITIAL + bradley_terry(wins, prior=prior)
+        for player, rating in zip(players, ratings):
+            player.rating = elo.RATING_CLASS(rating)
 
     def restart(self):
         for player in self.player_map.values():
@@ -280,18 +513,7 @@ class Controller(object):
                  timestamp_format='%Y-%m-%d-%H.%M',
                  result_path='~/.torcs/results/',
                  torcs_command=['torcs', '-r', '{config_file}'],
-                 driver_to_port=OrderedDict([
-                    ('scr_server 1', 3001),
-                    ('scr_server 2', 3002),
-                    ('scr_server 3', 3003),
-                    ('scr_server 4', 3004),
-                    ('scr_server 5', 3005),
-                    ('scr_server 6', 3006),
-                    ('scr_server 7', 3007),
-                    ('scr_server 8', 3008),
-                    ('scr_server 9', 3009),
-                    ('scr_server 10', 3010),
-                 ]),
+                 driver_to_port=None,
                  raise_on_too_fast_completion=True,
                  torcs_min_time=1,
                  torcs_child_wait=0.5,
@@ -308,11 +530,14 @@ class Controller(object):
         when running `save_ratings`.
 
         N.B. `~` is only expanded to the user directory in `result_path` at
-             initialisation of the controller.
+             initialisation of the controller. Likewise, the absolute path of
+             `torcs_config_file`, the directory TORCS saves its results in and
+             the command that starts TORCS are determined at initialisation.
         """
         self.rater = rater
         self.queue = queue
         self.torcs_config_file = torcs_config_file
+        self.torcs_config_path = os.path.abspath(torcs_config_file)
         self.server_stdout = server_stdout
         self.server_stderr = server_stderr
         self.separate_player_uid = separate_player_uid
@@ -327,8 +552,23 @@ class Controller(object):
         self.result_filename_format = result_filename_format
         self.timestamp_format = timestamp_format
         self.result_path = os.path.expanduser(result_path)
+        # TORCS saves the results in a directory named after the config file
+        self.result_dir = os.path.join(
+            self.result_path,
+            os.path.splitext(os.path.basename(torcs_config_file))[0]
+        )
+        # Names of the results files that existed before the last race, used
+        # to recognise the file TORCS writes. Read just before the first race.
+        self.known_results = None
         self.torcs_command = torcs_command
-        self.driver_to_port = driver_to_port
+        # The config file is the only thing filled in, so this never changes
+        self.torcs_start_command = [
+            arg.format(config_file=self.torcs_config_path)
+            for arg in torcs_command
+        ]
+        self.driver_to_port = dict(driver_to_port) \
+            if driver_to_port is not None \
+            else dict(DRIVER_TO_PORT)
         self.raise_on_too_fast_completion = raise_on_too_fast_completion
         self.torcs_min_time = torcs_min_time
         self.torcs_child_wait = torcs_child_wait
@@ -376,29 +616,69 @@ class Controller(object):
 
         NB. Driver names are _not_ tokens. One should first look up which token
             corresponds with which driver name.
+
+        The ranking is only parsed again when the file has been modified.
         """
-        with open(results_file) as fd:
-            soup = BeautifulSoup(fd, 'xml')
-        result_soup = soup.find('section', attrs={'name': 'Results'})
-        rank_soup = result_soup.find('section', attrs={'name': 'Rank'})
-        ranks = [
-            (
-                int(section['name']),
-                section.find('attstr', attrs={'name': 'name'})['val']
-            )
-            for section in rank_soup.findAll('section')
-        ]
-        return list(zip(*sorted(ranks)))[1]
+        return list(Controller.parse_ranking(
+            results_file,
+            os.path.getmtime(results_file)
+        ))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def parse_ranking(results_file, mtime):
+        # `mtime` is only used as part of the cache key
+        # Stream the file, so only the sections that are still needed are
+        # kept in memory. Every finished section that isn't part of the
+        # ranking is thrown away immediately.
+        for _, elem in etree.iterparse(results_file, tag='section'):
+            parent = elem.getparent()
+            if elem.get('name') == 'Rank' and any(
+                ancestor.get('name') == 'Results'
+                for ancestor in elem.iterancestors('section')
+            ):
+                ranks = [
+                    (
+                        int(section.get('name')),
+                        NAME_XPATH(section)[0]
+                    )
+                    for section in elem.iterfind('section')
+                ]
+                return tuple(zip(*sorted(ranks)))[1]
+            # Anything inside the Rank section is still needed
+            elif not any(
+                ancestor.get('name') == 'Rank'
+                for ancestor in elem.iterancestors('section')
+            ):
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+        raise ParseError(
+            "Error parsing {file}: no Rank section found in the "
+            "Results section.".format(file=results_file)
+        )
 
     @staticmethod
     def read_lineup(torcs_config_file):
-        with open(torcs_config_file) as fd:
-            soup = BeautifulSoup(fd, 'xml')
-        drivers_sec = soup.find('section', attrs={'name': 'Drivers'})
+        """
+        Return the driver names specified in the given TORCS config file.
+
+        The line-up is only parsed again when the file has been modified.
+        """
+        return list(Controller.parse_lineup(
+            torcs_config_file,
+            os.path.getmtime(torcs_config_file)
+        ))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def parse_lineup(torcs_config_file, mtime):
+        # `mtime` is only used as part of the cache key
+        tree = etree.parse(torcs_config_file)
         drivers = []
-        for sec in drivers_sec.findAll('section'):
+        for sec in DRIVERS_XPATH(tree):
             tag, attrs = 'attstr', {'name': 'module'}
-            module = sec.find(tag, attrs=attrs)
+            module = next(iter(MODULE_XPATH(sec)), None)
             if module is None:
                 raise ParseError(
                     "Error parsing {file}: expected a {tag} tag with the "
@@ -420,7 +700,7 @@ class Controller(object):
                 )
 
             tag, attrs = 'attnum', {'name': 'idx'}
-            idx = sec.find(tag, attrs=attrs)
+            idx = next(iter(IDX_XPATH(sec)), None)
             if idx is None:
                 raise ParseError(
                     "Error parsing {file}: expected a {tag} tag with the "
@@ -440,15 +720,15 @@ class Controller(object):
                         attr='val',
                     )
                 )
-            drivers.append((sec['name'], val))
+            drivers.append((sec.get('name'), val))
 
         # I now have a list of (rank, id) pairs
         # Somehow, the number in the name of the scr_server driver is one
         # larger than the `idx` of the driver.
-        return [
+        return tuple(
             'scr_server {}'.format(int(idx) + 1)
             for _, idx in sorted(drivers)
-        ]
+        )
 
     def restart(self):
         """Restart the tournament, making all ratings equal."""
@@ -462,18 +742,24 @@ class Controller(object):
             with open(filename, 'w') as file:
                 file.write(content)
 
-    def start_player(self, player, driver, simulate=False):
-        """Start a player"""
-        stdout = open(
-            player.stdout.format(timestamp=self.timestamp()),
-            'w'
-        )
-        self.open_files.append(stdout)
-        stderr = open(
-            player.stderr.format(timestamp=self.timestamp()),
-            'w'
-        )
-        self.open_files.append(stderr)
+    def start_player(self, player, driver, simulate=False, timestamp=None):
+        """
+        Start a player
+
+        If no `timestamp` is given, the current time is used to format the
+        output filenames.
+        """
+        if timestamp is None:
+            timestamp = self.timestamp()
+        stdout_filename = player.stdout.format(timestamp=timestamp)
+        stderr_filename = player.stderr.format(timestamp=timestamp)
+        if not simulate:
+            # Only the player writes to these files, so they don't need a
+            # buffer
+            stdout = open(stdout_filename, 'wb', buffering=0)
+            self.open_files.append(stdout)
+            stderr = open(stderr_filename, 'wb', buffering=0)
+            self.open_files.append(stderr)
 
         # Set the ownership of the files
         if self.set_file_owner:
@@ -482,15 +768,12 @@ class Controller(object):
         if self.set_file_mode:
             self.change_mode(player)
 
-        start_command = list(map(
-                    lambda s: s.format(
-                        port=self.driver_to_port[driver]
-                    ),
-                    player.start_command
-        ))
+        start_command = player.format_start_command(
+            self.driver_to_port[driver]
+        )
         logger.debug("Player start command: {}".format(start_command))
-        logger.debug("Player stdout: {}".format(stdout))
-        logger.debug("Player stderr: {}".format(stderr))
+        logger.debug("Player stdout: {}".format(stdout_filename))
+        logger.debug("Player stderr: {}".format(stderr_filename))
         logger.debug("Player working_dir: {}".format(
             player.working_dir
         ))
@@ -498,14 +781,13 @@ class Controller(object):
         if simulate:
             # Always simulate these functions, just to be sure they
             # work
-            self.get_change_user_fn(player)
+            self.get_change_user_command(player)
             self.get_player_env(player)
         elif self.separate_player_uid:
             processes.append(psutil.Popen(
-                start_command,
+                self.get_change_user_command(player) + start_command,
                 stdout=stdout,
                 stderr=stderr,
-                preexec_fn=self.get_change_user_fn(player),
                 cwd=player.working_dir,
                 env=self.get_player_env(player)
             ))
@@ -522,6 +804,9 @@ class Controller(object):
         # Like this we sleep too much (because I don't think we should wait
         # for several child processes added at the same time), but this will
         # probably not happen and otherwise just cost a few seconds.
+        # Players are arbitrary scripts, which may start short-lived child
+        # processes before the actual driver, so always wait the full
+        # `player_child_wait` instead of taking the first children found.
         for proc in processes:
             time.sleep(self.player_child_wait)
             processes.extend(proc.children())
@@ -573,8 +858,18 @@ class Controller(object):
             raise NotEnoughWorkingPlayers("No race run.")
 
     def race_tokens(self, tokens, simulate=False):
+        """Run one race with the players with the given tokens."""
+        tokens = list(tokens)
+        player_map = self.rater.player_map
+        unknown = [token for token in tokens if token not in player_map]
+        if unknown:
+            raise ValueError(
+                "Cannot race unknown player(s): {}".format(
+                    ', '.join(map(repr, unknown))
+                )
+            )
         return self.race_once(
-            map(self.rater.player_map.get, tokens),
+            [player_map[token] for token in tokens],
             simulate=simulate
         )
 
@@ -603,38 +898,45 @@ class Controller(object):
                 )
             )
 
-        driver_to_player = OrderedDict(zip(self.drivers, players))
+        driver_to_player = dict(zip(self.drivers, players))
+        # Use the same timestamp for all files belonging to this race
+        timestamp = self.timestamp()
+        # (name, basename) pairs of the server's output files, which are given
+        # to the players afterwards
+        server_files = []
+        if not simulate and self.known_results is None:
+            self.known_results = set(self.scan_results())
 
         try:
             # Start server
-            server_stdout = open(
-                self.server_stdout.format(timestamp=self.timestamp()),
-                'w'
-            )
-            self.open_files.append(server_stdout)
-            server_stderr = open(
-                self.server_stderr.format(timestamp=self.timestamp()),
-                'w'
-            )
-            self.open_files.append(server_stderr)
-
             logger.info("Starting TORCS...")
             if simulate:
                 logger.warning(
                     "This is a simulation! No child processes are started."
                 )
             else:
+                server_stdout = self.open_server_log(
+                    self.server_stdout.format(timestamp=timestamp)
+                )
+                self.open_files.append(server_stdout)
+                server_files.append(
+                    (server_stdout.name, os.path.basename(server_stdout.name))
+                )
+                server_stderr = self.open_server_log(
+                    self.server_stderr.format(timestamp=timestamp)
+                )
+                self.open_files.append(server_stderr)
+                server_files.append(
+                    (server_stderr.name, os.path.basename(server_stderr.name))
+                )
+
                 logger.debug(
                     "TORCS config to use: {}".format(self.torcs_config_file)
                 )
-                config_file = os.path.abspath(self.torcs_config_file)
-                logger.debug("TORCS config to use: {}".format(config_file))
-                command = list(map(
-                    lambda s: s.format(
-                        config_file=config_file
-                    ),
-                    self.torcs_command
-                ))
+                logger.debug(
+                    "TORCS config to use: {}".format(self.torcs_config_path)
+                )
+                command = self.torcs_start_command
                 logger.debug("TORCS command to be run: {}".format(command))
                 server_process = psutil.Popen(
                     command,
@@ -645,6 +947,10 @@ class Controller(object):
 
                 # TORCS starts a child process, which doesn't terminate
                 # automatically if `server_process` is terminated or crashes.
+                # The `torcs` launcher script may run short-lived helpers
+                # before it starts the actual game, so always wait the full
+                # `torcs_child_wait` instead of taking the first children
+                # found.
                 time.sleep(self.torcs_child_wait)
                 children = server_process.children()
                 logger.debug("TORCS server children: {}".format(children))
@@ -652,33 +958,48 @@ class Controller(object):
 
             # Start players
             logger.info("Starting players...")
-            # If the race is retried several times because a player failed,
-            # the start of the queue will contain working players. To make
-            # sure these don't have to be started every time a new (possibly
-            # failing) player is tried, the players are started in reversed
-            # order. Like this the new player will be started first and can be
-            # "replaced" on fail without having to start all the working
-            # players.
-            for driver, player in reversed(driver_to_player.items()):
-                self.start_player(player, driver, simulate=simulate)
-            del driver, player
-
-            time.sleep(self.crash_check_wait)
+            # Players are started concurrently, so the time spent starting
+            # them and waiting for their child processes overlaps.
+            start_player = functools.partial(
+                self.start_player,
+                simulate=simulate,
+                timestamp=timestamp
+            )
+            with ThreadPoolExecutor(max(1, len(driver_to_player))) as executor:
+                # Exhaust the iterator to raise any exception that occurred
+                list(executor.map(
+                    start_player,
+                    driver_to_player.values(),
+                    driver_to_player.keys()
+                ))
 
             # Check no one crashed in the mean time
-            for token, procs in self.player_processes.items():
+            # When simulating, no processes were started that could crash.
+            if not simulate:
                 # The first process is the only one I'm checking. I shouldn't
                 # care if any child processes died.
-                proc = procs[0]
-                # If the following line fails then someone f*d up the players
-                player = next(p for p in players if p.token == token)
-                if not really_running(proc):
-                    name = proc.name() if hasattr(proc, 'name') else proc
-                    raise PlayerCrashedError(
-                        player,
-                        proc.poll() if hasattr(proc, 'poll') else 'Unknown',
-                        list(proc.args) or name
-                    )
+                first_processes = [
+                    (player, self.player_processes[player.token][0])
+                    for player in driver_to_player.values()
+                ]
+                # Stop waiting as soon as someone crashed. These processes
+                # are children of this process, so `wait_procs` only needs to
+                # ask whether they exited, and reaps them if they did.
+                crashed = poll_until(
+                    lambda: psutil.wait_procs(
+                        [proc for _, proc in first_processes],
+                        timeout=0
+                    )[0],
+                    self.crash_check_wait
+                )
+                # Report crashes in line-up order
+                for player, proc in first_processes:
+                    if proc in crashed:
+                        raise PlayerCrashedError(
+                            player,
+                            proc.returncode,
+                            list(proc.args)
+                        )
 
             # Wait for server
             logger.info("Waiting for TORCS to finish...")
@@ -723,43 +1044,40 @@ class Controller(object):
             # Exit running processes
 
             if not simulate:
-                # Wait a second to give the processes some time
-                time.sleep(self.shutdown_wait)
+                processes = list(it.chain(
+                    self.server_processes,
+                    *self.player_processes.values()
+                ))
+                # Give the processes some time to stop by themselves
+                running = stop_waiting(processes, self.shutdown_wait)
 
                 logger.debug(
                     "Player processes before stopping: {}".format(
                         self.player_processes
                     )
                 )
-                processes = list(it.chain(
-                    self.server_processes,
-                    *self.player_processes.values()
-                ))
                 # First be nice
-                for proc in processes:
-                    if really_running(proc):
-                        logger.info("Terminating {}".format(proc))
-                        proc.terminate()
+                for proc in running:
+                    logger.info("Terminating {}".format(proc))
+                    proc.terminate()
 
-                # Wait a second to give the processes some time
-                time.sleep(self.shutdown_wait)
+                # Give the processes some time to terminate
+                running = stop_waiting(running, self.shutdown_wait)
 
                 # Time's up
-                for proc in processes:
-                    if really_running(proc):
-                        logger.warning("Killing {}".format(proc))
-                        proc.kill()
+                for proc in running:
+                    logger.warning("Killing {}".format(proc))
+                    proc.kill()
 
-                # Wait a second to give the processes some time
-                time.sleep(self.shutdown_wait)
+                # Give the processes some time to die
+                running = stop_waiting(running, self.shutdown_wait)
 
                 # Double check
-                for proc in processes:
-                    if really_running(proc):
-                        logger.error(
-                            "The following process could not be killed: {}"
-                            .format(proc.cmdline())
-                        )
+                for proc in running:
+                    logger.error(
+                        "The following process could not be killed: {}"
+                        .format(proc.cmdline())
+                    )
                 self.clear_processess()
 
             # Close all open files
@@ -773,41 +1091,45 @@ class Controller(object):
             logger.info("Closed all files and processes!")
 
             # Give the players the server output
-            for player in players:
-                shutil.copyfile(
-                    server_stdout.name,
-                    os.path.join(
-                        player.output_dir,
-                        os.path.basename(server_stdout.name)
-                    )
-                )
-                shutil.copyfile(
-                    server_stderr.name,
-                    os.path.join(
-                        player.output_dir,
-                        os.path.basename(server_stderr.name)
-                    )
-                )
+            self.distribute_files(
+                (src, os.path.join(player.output_dir, base))
+                for player in players
+                for src, base in server_files
+            )
 
             # End of `finally` clause
 
         # Find the correct results file
-        logger.debug("Result path: {}".format(self.result_path))
-        out_dir = os.path.join(
-            self.result_path,
-            # remove head path and extension
-            '.'.join(os.path.split(self.torcs_config_file)[1].split('.')[:-1])
-        )
-
-        out_base = sorted(os.listdir(out_dir))[-1]
-        out_file = os.path.join(
-            out_dir,
-            out_base
-        )
+        logger.debug("Result directory: {}".format(self.result_dir))
+        results = self.scan_results()
+        if simulate:
+            # No race was run, so use whatever results there are
+            candidates = list(results)
+        else:
+            candidates = [
+                name for name in results if name not in self.known_results
+            ]
+            self.known_results = set(results)
+            if not candidates:
+                # Using an old results file would count that race twice
+                raise subprocess.SubprocessError(
+                    "TORCS didn't write a new results file in {}".format(
+                        self.result_dir
+                    )
+                )
+        if not candidates:
+            raise FileNotFoundError(
+                "No results file found in {}".format(self.result_dir)
+            )
+        # The results file names sort chronologically, so the newest one is
+        # the largest name.
+        newest = results[max(candidates)]
+        out_base = newest.name
+        out_file = newest.path
 
         # Give the players the results file
-        for driver, player in driver_to_player.items():
-            shutil.copyfile(
+        self.distribute_files(
+            (
                 out_file,
                 os.path.join(
                     player.output_dir,
@@ -817,6 +1139,8 @@ class Controller(object):
                     )
                 )
             )
+            for driver, player in driver_to_player.items()
+        )
 
         # Update ratings according to ranking
         ranked_drivers = self.read_ranking(out_file)
@@ -825,7 +1149,7 @@ class Controller(object):
         # Make a backup if self.rater_backup_filename is given
         if self.rater_backup_filename is not None:
             backup_filename = self.rater_backup_filename.format(
-                timestamp=self.timestamp()
+                timestamp=timestamp
             )
             # logger.info("Backing up ratings in {}".format(backup_filename))
             self.rater.save_ratings(
@@ -851,24 +1175,95 @@ class Controller(object):
                 )
                 fd.write('\n')
 
+    def scan_results(self):
+        """
+        Return a `{name: os.DirEntry}` mapping of the files in
+        `self.result_dir`, which is empty if the directory doesn't exist.
+        """
+        try:
+            with os.scandir(self.result_dir) as entries:
+                return {entry.name: entry for entry in entries}
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def open_server_log(filename):
+        """
+        Open a server log for writing.
+
+        The players get hard links to the server logs, so an existing log is
+        removed instead of truncated. This happens when a race is retried
+        within the same minute, and truncating would also empty the logs the
+        players got from the previous attempt.
+        """
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        # Only TORCS writes to these files, so they don't need a buffer
+        return open(filename, 'wb', buffering=0)
+
+    def distribute_files(self, files):
+        """
+        Distribute several files at once, see `distribute_file`.
+
+        `files` is an iterable of `(src, dst)` pairs. The files are
+        distributed concurrently, because this is mostly waiting for the disk.
+        """
+        files = list(files)
+        if not files:
+            return
+        sources, destinations = zip(*files)
+        with ThreadPoolExecutor(min(32, len(files))) as executor:
+            # Exhaust the iterator to raise any exception that occurred
+            list(executor.map(self.distribute_file, sources, destinations))
+
+    def distribute_file(self, src, dst):
+        """
+        Give a player a copy of `src` at `dst`.
+
+        A hard link is used if possible, which doesn't copy any data. If the
+        owner or mode of player files is changed by this controller, a real
+        copy is made instead, because these changes would otherwise apply to
+        all links at once.
+        """
+        if os.path.lexists(dst):
+            # Never write through an existing link
+            os.remove(dst)
+        if not (self.set_file_owner or self.set_file_mode):
+            try:
+                os.link(src, dst)
+            except OSError as e:
+                logger.debug("Could not link {}: {}".format(dst, e))
+            else:
+                return
+        shutil.copyfile(src, dst)
+
     def change_owner(self, player):
         """
         Make `player.process_owner` the owner of all files in
         `player.working_dir`
         """
-        pw_record = pwd.getpwnam(player.process_owner)
+        pw_record = get_password_record(player.process_owner)
+        uid, gid = pw_record.pw_uid, pw_record.pw_gid
         logger.debug(
             "Changing file ownership for {}".format(player.token)
         )
-        for dirpath, _, filenames in os.walk(player.working_dir):
+        # `os.fwalk` gives a file descriptor of every directory, so the paths
+        # of the files don't have to be resolved over and over again.
+        for _, _, filenames, dirfd in os.fwalk(player.working_dir):
             # Change directory ownership
-            os.chown(dirpath, pw_record.pw_uid, pw_record.pw_gid)
+            os.chown(dirfd, uid, gid)
             # Change file ownership
+            # Symbolic links themselves are changed, not whatever they point
+            # to, which might be outside of the working directory.
             for filename in filenames:
                 os.chown(
-                    os.path.join(dirpath, filename),
-                    pw_record.pw_uid,
-                    pw_record.pw_gid
+                    filename,
+                    uid,
+                    gid,
+                    dir_fd=dirfd,
+                    follow_symlinks=False
                 )
 
     def change_mode(self, player, mode=None):
@@ -889,37 +1284,29 @@ class Controller(object):
                 os.chmod(os.path.join(dirpath, filename), mode)
 
     @staticmethod
-    def get_change_user_fn(player):
-        pw_record = pwd.getpwnam(player.process_owner)
-
-        def change_user():
-            logger.debug(
-                "Starting demotion. UID: {uid}, GID: {gid}".format(
-                    uid=os.getuid(),
-                    gid=os.getgid()
-                )
-            )
-            try:
-                logger.debug("Trying to set gid...")
-                os.setgid(pw_record.pw_gid)
-                logger.debug("Trying to set uid...")
-                os.setuid(pw_record.pw_uid)
-            except Exception as e:
-                logger.error(e)
-                raise
-            logger.debug(
-                "Finished demotion. UID: {uid}, GID: {gid}".format(
-                    uid=os.getuid(),
-                    gid=os.getgid()
-                )
-            )
+    def get_change_user_command(player):
+        """
+        Return the command prefix that runs a command as
+        `player.process_owner`.
 
-        return change_user
+        `setpriv` changes the user and groups and then executes the command,
+        so no Python code has to run in the child process between `fork` and
+        `exec`. That would not be safe, because players are started from
+        several threads.
+        """
+        pw_record = get_password_record(player.process_owner)
+        return [
+            'setpriv',
+            '--reuid={}'.format(pw_record.pw_uid),
+            '--regid={}'.format(pw_record.pw_gid),
+            '--init-groups',
+            '--',
+        ]
 
     @staticmethod
     def get_player_env(player):
         # Info from https://stackoverflow.com/questions/1770209/run-child-processes-as-different-user-from-a-long-running-process/6037494#6037494  # NOQA
-        pw_record = pwd.getpwnam(player.process_owner)
+        pw_record = get_password_record(player.process_owner)
         env = os.environ.copy()
         env['LOGNAME'] = env['USER'] = pw_record.pw_name
         env['HOME'] = pw_record.pw_dir
@@ -964,11 +1351,7 @@ class Controller(object):
                 }
             }
         """
-        error_regex = re.compile(
-            r"__init__\(\) got an unexpected keyword argument '(\w+)'"
-        )
-        with open(config_file) as fd:
-            config = yaml.load(fd, OrderedLoader)
+        config = load_yaml(config_file)
         for key, value in extra_config.items():
             if isinstance(value, abc.Mapping):
                 cur_conf = config.setdefault(key, {})
@@ -981,7 +1364,7 @@ class Controller(object):
             fbq = cls.load_fbq(config, rater.player_map.values())
             controller = cls(rater, fbq, **config.get('controller', {}))
         except TypeError as e:
-            match = error_regex.fullmatch(e.args[0])
+            match = UNEXPECTED_KEYWORD_REGEX.fullmatch(e.args[0])
             if match is not None:
                 config_key = match.groups()[0]
                 logger.debug("Match: {}".format(config_key))
@@ -1019,17 +1402,12 @@ class Controller(object):
                     players=players
                 )
             )
-            fd = None
             try:
-                fd = open(players)
+                fd = open(players, 'rb')
             except Exception as e:
                 raise the_exception from e
-            else:
+            with fd:
                 players = yaml.load(fd, OrderedLoader)
-            finally:
-                if fd is not None:
-                    fd.close()
-                    # logger.debug("Closed players config!")
             if not isinstance(players, abc.Mapping):
                 raise the_exception
         return [
@@ -1054,6 +1432,15 @@ class DropboxDisablingController(Controller):
 
     def race(self, *args, **kwargs):
         """Disable Dropbox before racing and start it again afterwards."""
+        if not (self.stop_dropbox or self.start_dropbox):
+            return super(DropboxDisablingController, self).race(
+                *args,
+                **kwargs
+            )
+
+        # Only capture what Dropbox says if it is going to be logged
+        stdout = subprocess.PIPE if logger.isEnabledFor(logging.INFO) \
+            else subprocess.DEVNULL
         try:
             # Try to disable Dropbox
             # The catch is that the return status of the Dropbox control script
@@ -1062,12 +1449,13 @@ class DropboxDisablingController(Controller):
                 logger.info("Stopping Dropbox...")
                 completed = subprocess.run(
                     self.dropbox_stop_command,
-                    stdout=subprocess.PIPE,
+                    stdout=stdout,
                     stderr=subprocess.PIPE
                 )
-                logger.info("Dropbox says:\n{}".format(
-                    completed.stdout.decode()
-                ))
+                if completed.stdout is not None:
+                    logger.info("Dropbox says:\n{}".format(
+                        completed.stdout.decode()
+                    ))
                 del completed
 
             # Race
@@ -1090,12 +1478,13 @@ class DropboxDisablingController(Controller):
                     else subprocess.DEVNULL
                 completed = subprocess.run(
                     self.dropbox_start_command,
-                    stdout=subprocess.PIPE,
+                    stdout=stdout,
                     stderr=stderr
                 )
-                logger.info(
-                    "Dropbox says:\n{}".format(completed.stdout.decode())
-                )
+                if completed.stdout is not None:
+                    logger.info(
+                        "Dropbox says:\n{}".format(completed.stdout.decode())
+                    )
                 del completed
 
 
@@ -1108,6 +1497,8 @@ class FileBasedQueue(object):
     def __init__(self, players, filename='start.sh'):
         self.filename = filename
         self.players = list(players)
+        # Queue file of every player, by token
+        self.filenames = {}
 
     def __len__(self):
         return len(self.players)
@@ -1120,33 +1511,48 @@ class FileBasedQueue(object):
         I.E. create it if it does not exist or change the last modified time
         to the current time if it does.
         """
-        logger.debug("Touching: {}".format(filename))
-        pathlib.Path(filename).touch()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Touching: {}".format(filename))
+        try:
+            os.utime(filename, None)
+        except FileNotFoundError:
+            open(filename, 'ab').close()
         logger.debug("Touched!")
 
     @staticmethod
     def get_last_modified(filename):
-        modified_time = os.path.getmtime(filename)
-        logger.debug("Filename: {}".format(filename))
-        logger.debug("Modified time: {}".format(modified_time))
+        """Return the last modified time of a file in nanoseconds."""
+        # Unlike the float `st_mtime`, this is exact, so files touched
+        # shortly after each other never compare as equal
+        modified_time = os.stat(filename).st_mtime_ns
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Filename: {}".format(filename))
+            logger.debug("Modified time: {}".format(modified_time))
         return modified_time
 
     def get_filename(self, player):
         """Get the full path to the queue file of a player"""
-        return os.path.join(
-            player.working_dir,
-            self.filename
-        )
+        if player.token not in self.filenames:
+            self.filenames[player.token] = os.path.join(
+                player.working_dir,
+                self.filename
+            )
+        return self.filenames[player.token]
 
     def first_n(self, n):
         """
         Get the `n` players that are first in line
         """
-        return sorted(
-            self.players,
-            key=lambda p: self.get_last_modified(self.get_filename(p)),
-            # reverse=True,
-        )[:n]
+        # Every file is stat'ed exactly once, and only the first `n` players
+        # are ordered. Ties keep the order of `self.players`.
+        modified_times = [
+            (self.get_last_modified(self.get_filename(player)), index, player)
+            for index, player in enumerate(self.players)
+        ]
+        return [
+            player
+            for _, _, player in heapq.nsmallest(n, modified_times)
+        ]
 
     def requeue(self, player):
         """
@@ -1159,10 +1565,9 @@ class FileBasedQueue(object):
 
 def log_level_type(string):
     try:
-        value = int(string)
-    except:
-        value = string
-    return value
+        return int(string)
+    except ValueError:
+        return string
 
 
 if __name__ == '__main__':